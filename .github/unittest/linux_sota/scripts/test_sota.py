@@ -238,7 +238,29 @@ commands = {
   collector.total_frames=48 \
   optim.batch_size=10 \
   collector.frames_per_batch=16 \
-  collector.env_per_collector=1 \
+  env.train_num_envs=1 \
+  logger.mode=offline \
+  logger.backend=
+""",
+    "cql_online-compile": """python sota-implementations/cql/cql_online.py \
+  collector.total_frames=48 \
+  collector.init_random_frames=10 \
+  optim.batch_size=10 \
+  collector.frames_per_batch=16 \
+  env.train_num_envs=1 \
+  compile.compile=True \
+  logger.mode=offline \
+  logger.backend=
+""",
+    "cql_online-prb": """python sota-implementations/cql/cql_online.py \
+  collector.total_frames=48 \
+  collector.init_random_frames=10 \
+  optim.batch_size=10 \
+  collector.frames_per_batch=16 \
+  env.train_num_envs=1 \
+  replay_buffer.prb=1 \
+  replay_buffer.gpu_sampler=True \
+  replay_buffer.size=120 \
   logger.mode=offline \
   logger.backend=
 """,
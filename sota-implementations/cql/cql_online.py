@@ -22,7 +22,7 @@ import tqdm
 from tensordict import TensorDict
 from tensordict.nn import CudaGraphModule
 
-from torchrl._utils import timeit
+from torchrl._utils import compile_with_warmup, timeit
 from torchrl.envs.utils import ExplorationType, set_exploration_type
 from torchrl.objectives import group_optimizers
 from torchrl.record.loggers import generate_exp_name, get_logger
@@ -70,6 +70,16 @@ def main(cfg: "DictConfig"):  # noqa: F821
             device = "cpu"
     device = torch.device(device)
 
+    # Check the update schedule before building anything
+    updates_per_call = cfg.optim.updates_per_call
+    num_updates = int(cfg.collector.frames_per_batch * cfg.optim.utd_ratio)
+    if num_updates % updates_per_call:
+        raise ValueError(
+            f"The number of updates per collection step ({num_updates}) must be a "
+            f"multiple of optim.updates_per_call ({updates_per_call})."
+        )
+    num_update_calls = num_updates // updates_per_call
+
     # Create env
     train_env, eval_env = make_environment(
         cfg,
@@ -79,11 +89,23 @@ def main(cfg: "DictConfig"):  # noqa: F821
     )
 
     # Create replay buffer
+    # A buffer that fits in device memory can be kept there, in which case neither
+    # extending nor sampling goes through the host
+    rb_device = cfg.replay_buffer.device
+    if rb_device in ("", None):
+        rb_device = "cpu"
+    rb_device = torch.device(rb_device)
     replay_buffer = make_replay_buffer(
         batch_size=cfg.optim.batch_size,
         prb=cfg.replay_buffer.prb,
         buffer_size=cfg.replay_buffer.size,
-        device="cpu",
+        device=rb_device,
+        prefetch=cfg.replay_buffer.buffer_prefetch,
+        gpu_sampler=cfg.replay_buffer.gpu_sampler,
+        # the prioritized sampler runs on the training device, wherever the data is
+        sampler_device=device,
+        # Pinned samples make the host-to-device copy in the update loop asynchronous
+        pin_memory=rb_device.type == "cpu" and device.type == "cuda",
     )
 
     # create agent
@@ -93,6 +115,19 @@ def main(cfg: "DictConfig"):  # noqa: F821
     if cfg.compile.compile:
         if cfg.compile.compile_mode not in (None, ""):
             compile_mode = cfg.compile.compile_mode
+            if cfg.compile.cudagraphs and compile_mode in (
+                "reduce-overhead",
+                "max-autotune",
+            ):
+                # CUDA graphs would be captured twice: once by inductor and once by
+                # CudaGraphModule
+                warnings.warn(
+                    f"compile_mode={compile_mode} already uses CUDA graphs and is "
+                    f"incompatible with cudagraphs=True. Falling back on "
+                    f"compile_mode='default'.",
+                    category=UserWarning,
+                )
+                compile_mode = "default"
         elif cfg.compile.cudagraphs:
             compile_mode = "default"
         else:
@@ -108,10 +143,18 @@ def main(cfg: "DictConfig"):  # noqa: F821
         cudagraph=cfg.compile.cudagraphs,
     )
 
-    # Create loss
-    loss_module, target_net_updater = make_continuous_loss(
-        cfg.loss, model, device=device
-    )
+    # The collector only holds a separate copy of the policy weights when these had
+    # to be cast to another device, otherwise it shares them with the trained actor
+    sync_policy_weights = collector.get_weights_fn is not None
+
+    # The evaluation policy shares its parameters with the trained actor. The
+    # compiled module still exposes them, such that rollout can cast the inputs.
+    eval_actor = model[0]
+    if compile_mode:
+        eval_actor = torch.compile(eval_actor, mode=compile_mode)
+
+    # Create loss (the target network soft update is done by ema_step below)
+    loss_module, _ = make_continuous_loss(cfg.loss, model, device=device)
 
     # Create optimizer
     (
@@ -124,29 +167,67 @@ def main(cfg: "DictConfig"):  # noqa: F821
         policy_optim, critic_optim, alpha_optim, alpha_prime_optim
     )
 
-    def update(sampled_tensordict):
-
-        loss_td = loss_module(sampled_tensordict)
-
-        actor_loss = loss_td["loss_actor"]
-        q_loss = loss_td["loss_qvalue"]
-        cql_loss = loss_td["loss_cql"]
-        q_loss = q_loss + cql_loss
-        alpha_loss = loss_td["loss_alpha"]
-        alpha_prime_loss = loss_td["loss_alpha_prime"]
-
-        total_loss = alpha_loss + actor_loss + alpha_prime_loss + q_loss
-        total_loss.backward()
-        optimizer.step()
-        optimizer.zero_grad(set_to_none=True)
-
-        # update qnet_target params
-        target_net_updater.step()
-
-        return loss_td.detach()
+    # Gather the target and source parameters once so that the soft update of the
+    # target network is a single fused kernel rather than one lerp per parameter
+    target_keys = list(loss_module.target_qvalue_network_params.keys(True, True))
+    target_params = [
+        loss_module.target_qvalue_network_params.get(key) for key in target_keys
+    ]
+    source_params = [loss_module.qvalue_network_params.get(key) for key in target_keys]
+    tau = cfg.loss.tau
+
+    @torch.no_grad()
+    def ema_step():
+        torch._foreach_lerp_(target_params, source_params, tau)
+
+    priority_key = loss_module.tensor_keys.priority
+    # the loss entries that are logged
+    loss_keys = (
+        "loss_actor",
+        "loss_qvalue",
+        "loss_alpha",
+        "loss_alpha_prime",
+        "entropy",
+    )
+    # bfloat16 has the range of float32, hence no gradient scaling is required
+    autocast = cfg.optim.autocast
+
+    def update(sampled_stack):
+        # Run several optimization steps per call so that a single compiled graph
+        # (or CUDA graph replay) covers all of them
+        loss_tds = []
+        td_errors = []
+        for k in range(updates_per_call):
+            sampled_tensordict = sampled_stack[k]
+            with torch.autocast(
+                device_type=device.type, dtype=torch.bfloat16, enabled=autocast
+            ):
+                loss_td = loss_module(sampled_tensordict)
+
+            actor_loss = loss_td["loss_actor"]
+            q_loss = loss_td["loss_qvalue"]
+            cql_loss = loss_td["loss_cql"]
+            q_loss = q_loss + cql_loss
+            alpha_loss = loss_td["loss_alpha"]
+            alpha_prime_loss = loss_td["loss_alpha_prime"]
+
+            total_loss = alpha_loss + actor_loss + alpha_prime_loss + q_loss
+            total_loss.backward()
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+
+            # update qnet_target params
+            ema_step()
+
+            loss_tds.append(loss_td.select(*loss_keys).detach())
+            td_errors.append(sampled_tensordict.get(priority_key))
+
+        # write the priorities back in the stack for the prioritized buffer
+        sampled_stack.set(priority_key, torch.stack(td_errors))
+        return torch.stack(loss_tds)
 
     if compile_mode:
-        update = torch.compile(update, mode=compile_mode)
+        update = compile_with_warmup(update, mode=compile_mode, warmup=1)
     if cfg.compile.cudagraphs:
         warnings.warn(
             "CudaGraphModule is experimental and may lead to silently wrong results. Use with caution.",
@@ -156,15 +237,22 @@ def main(cfg: "DictConfig"):  # noqa: F821
 
     # Main loop
     collected_frames = 0
-    pbar = tqdm.tqdm(total=cfg.collector.total_frames)
+    total_frames = cfg.collector.total_frames
+    pbar = tqdm.tqdm(total=total_frames)
 
     init_random_frames = cfg.collector.init_random_frames
-    num_updates = int(cfg.collector.frames_per_batch * cfg.optim.utd_ratio)
     prb = cfg.replay_buffer.prb
     frames_per_batch = cfg.collector.frames_per_batch
     evaluation_interval = cfg.logger.log_interval
     eval_rollout_steps = cfg.logger.eval_steps
 
+    # Allocated once and written in place at every optimization step
+    log_loss_td = TensorDict(
+        {key: torch.zeros(num_updates, device=device) for key in loss_keys},
+        batch_size=[num_updates],
+        device=device,
+    )
+
     c_iter = iter(collector)
     total_iter = len(collector)
     for i in range(total_iter):
@@ -173,7 +261,8 @@ def main(cfg: "DictConfig"):  # noqa: F821
             tensordict = next(c_iter)
         pbar.update(tensordict.numel())
         # update weights of the inference policy
-        collector.update_policy_weights_()
+        if sync_policy_weights:
+            collector.update_policy_weights_()
 
         with timeit("rb - extend"):
             tensordict = tensordict.view(-1)
@@ -182,57 +271,76 @@ def main(cfg: "DictConfig"):  # noqa: F821
             replay_buffer.extend(tensordict)
             collected_frames += current_frames
 
-        if collected_frames >= init_random_frames:
-            log_loss_td = TensorDict(batch_size=[num_updates], device=device)
-            for j in range(num_updates):
+        # with utd_ratio=0 the agent is never trained and no loss is logged
+        train = num_update_calls > 0 and collected_frames >= init_random_frames
+        if train:
+            # priorities are written back to the buffer once all updates are done
+            sampled_priorities = []
+            for j in range(num_update_calls):
                 pbar.set_description(f"optim iter {j}")
                 with timeit("rb - sample"):
-                    # sample from replay buffer
-                    sampled_tensordict = replay_buffer.sample().to(device)
+                    # sample from replay buffer, one batch per optimization step
+                    samples = [
+                        replay_buffer.sample().to(device, non_blocking=True)
+                        for _ in range(updates_per_call)
+                    ]
+                    # a single batch is viewed rather than copied into a stack
+                    if updates_per_call > 1:
+                        sampled_stack = torch.stack(samples)
+                    else:
+                        sampled_stack = samples[0].unsqueeze(0)
 
                 with timeit("update"):
                     torch.compiler.cudagraph_mark_step_begin()
-                    loss_td = update(sampled_tensordict)
-                log_loss_td[j] = loss_td.detach()
-                # update priority
+                    loss_td = update(sampled_stack)
+                log_loss_td[
+                    j * updates_per_call : (j + 1) * updates_per_call
+                ] = loss_td.detach()
                 if prb:
-                    with timeit("rb - update priority"):
-                        replay_buffer.update_priority(sampled_tensordict)
+                    # cloned as graph outputs may be overwritten by the next call
+                    sampled_priorities.append(
+                        sampled_stack.select("index", priority_key).reshape(-1).clone()
+                    )
+            # update priority
+            if prb:
+                with timeit("rb - update priority"):
+                    replay_buffer.update_tensordict_priority(
+                        torch.cat(sampled_priorities)
+                    )
 
-        episode_rewards = tensordict["next", "episode_reward"][
-            tensordict["next", "done"]
-        ]
+        done = tensordict["next", "done"]
+        episode_rewards = tensordict["next", "episode_reward"][done]
         # Logging
         metrics_to_log = {}
         if len(episode_rewards) > 0:
-            episode_length = tensordict["next", "step_count"][
-                tensordict["next", "done"]
-            ]
-            metrics_to_log["train/reward"] = episode_rewards.mean().item()
-            metrics_to_log["train/episode_length"] = episode_length.sum().item() / len(
-                episode_length
-            )
-        if collected_frames >= init_random_frames:
-            metrics_to_log["train/loss_actor"] = log_loss_td.get("loss_actor").mean()
-            metrics_to_log["train/loss_qvalue"] = log_loss_td.get("loss_qvalue").mean()
-            metrics_to_log["train/loss_alpha"] = log_loss_td.get("loss_alpha").mean()
-            metrics_to_log["train/loss_alpha_prime"] = log_loss_td.get(
-                "loss_alpha_prime"
-            ).mean()
-            metrics_to_log["train/entropy"] = log_loss_td.get("entropy").mean()
+            episode_length = tensordict["next", "step_count"][done]
+            # Both statistics are moved to the host together
+            (
+                metrics_to_log["train/reward"],
+                metrics_to_log["train/episode_length"],
+            ) = torch.stack(
+                [episode_rewards.float().mean(), episode_length.float().mean()]
+            ).tolist()
+        if train:
+            # Gather all the loss metrics in a single device-to-host transfer
+            loss_values = torch.stack(
+                [log_loss_td.get(key).mean() for key in loss_keys]
+            ).tolist()
+            for key, value in zip(loss_keys, loss_values):
+                metrics_to_log[f"train/{key}"] = value
 
         # Evaluation
         with timeit("eval"):
             prev_test_frame = ((i - 1) * frames_per_batch) // evaluation_interval
             cur_test_frame = (i * frames_per_batch) // evaluation_interval
-            final = current_frames >= collector.total_frames
+            final = collected_frames >= total_frames
             if (i >= 1 and (prev_test_frame < cur_test_frame)) or final:
                 with set_exploration_type(
                     ExplorationType.DETERMINISTIC
                 ), torch.no_grad():
                     eval_rollout = eval_env.rollout(
                         eval_rollout_steps,
-                        model[0],
+                        eval_actor,
                         auto_cast_to_device=True,
                         break_when_any_done=True,
                     )
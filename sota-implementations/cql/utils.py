@@ -5,6 +5,7 @@
 from __future__ import annotations
 
 import functools
+from pathlib import Path
 
 import torch.nn
 import torch.optim
@@ -15,11 +16,12 @@ from torchrl.collectors import SyncDataCollector
 from torchrl.data import (
     Composite,
     LazyMemmapStorage,
+    LazyTensorStorage,
     TensorDictPrioritizedReplayBuffer,
     TensorDictReplayBuffer,
 )
 from torchrl.data.datasets.d4rl import D4RLExperienceReplay
-from torchrl.data.replay_buffers import SamplerWithoutReplacement
+from torchrl.data.replay_buffers import PrioritizedSampler, SamplerWithoutReplacement
 from torchrl.envs import (
     CatTensors,
     Compose,
@@ -145,6 +147,104 @@ def make_collector(
     return collector
 
 
+class MultinomialPrioritizedSampler(PrioritizedSampler):
+    """A prioritized sampler that keeps its priorities in a single tensor.
+
+    Indices are drawn with :func:`torch.multinomial` over the priorities instead of
+    walking the CPU sum-tree of :class:`~torchrl.data.PrioritizedSampler`. The
+    priorities live on ``device`` (typically the training accelerator) such that
+    sampling and priority updates run there; the sampled indices are moved to the
+    device of the storage.
+
+    Only one-dimensional storages are supported: multi-dimensional indices (and the
+    ``storage`` argument of :meth:`update_priority` used to flatten them) are not.
+    Indices equal to ``-1``, which :class:`~torchrl.data.replay_buffers.MaxValueWriter`
+    uses for items that should not be updated, are ignored.
+    """
+
+    def __init__(
+        self,
+        max_capacity: int,
+        alpha: float,
+        beta: float,
+        eps: float = 1e-8,
+        reduction: str = "max",
+        device: torch.device = "cpu",
+    ) -> None:
+        self._device = torch.device(device)
+        super().__init__(max_capacity, alpha, beta, eps, reduction=reduction)
+
+    def _init(self):
+        # The extra trailing slot receives the writes of ignored (-1) indices and is
+        # never sampled
+        self._priorities = torch.zeros(self._max_capacity + 1, device=self._device)
+        self._max_priority = None
+
+    def sample(self, storage, batch_size):
+        if len(storage) == 0:
+            raise RuntimeError("Cannot sample from an empty storage.")
+        priorities = self._priorities[: len(storage)]
+        index = torch.multinomial(
+            priorities, batch_size, replacement=True, generator=self._rng
+        )
+        # Importance sampling weight: (p_i / min(p)) ^ (-beta)
+        weight = torch.pow(priorities[index] / priorities.min(), -self._beta)
+        storage_device = getattr(storage, "device", None)
+        if isinstance(storage_device, torch.device):
+            index = index.to(storage_device)
+            weight = weight.to(storage_device)
+        return index, {"_weight": weight}
+
+    @torch.no_grad()
+    def update_priority(self, index, priority, *, storage=None):
+        priority = torch.as_tensor(
+            priority, dtype=self._priorities.dtype, device=self._device
+        ).detach()
+        index = torch.as_tensor(index, dtype=torch.long, device=self._device)
+        if index.ndim > 1:
+            raise ValueError(
+                f"{type(self).__name__} only supports one-dimensional storages, got "
+                f"an index of shape {index.shape}."
+            )
+        priority = priority.reshape(index.shape) if priority.numel() > 1 else priority
+        priority = priority.expand(index.shape)
+        # Redirect ignored indices to the trailing slot rather than filtering them,
+        # which would require a device synchronization
+        valid_index = index >= 0
+        index = torch.where(valid_index, index, self._max_capacity)
+        # the max priority is kept as a tensor to avoid a device synchronization
+        max_p = torch.where(valid_index, priority, 0).max()
+        cur_max_priority = self._max_priority[0]
+        if cur_max_priority is not None:
+            max_p = torch.maximum(max_p, cur_max_priority)
+        self._max_priority = (max_p, None)
+        self._priorities[index] = torch.pow(priority + self._eps, self._alpha)
+
+    def state_dict(self):
+        return {
+            "_alpha": self._alpha,
+            "_beta": self._beta,
+            "_eps": self._eps,
+            "_max_priority": self._max_priority,
+            "_priorities": self._priorities.clone(),
+        }
+
+    def load_state_dict(self, state_dict):
+        self._alpha = state_dict["_alpha"]
+        self._beta = state_dict["_beta"]
+        self._eps = state_dict["_eps"]
+        self._max_priority = state_dict["_max_priority"]
+        self._priorities.copy_(state_dict["_priorities"])
+
+    def dumps(self, path):
+        path = Path(path).absolute()
+        path.mkdir(exist_ok=True)
+        torch.save(self.state_dict(), path / "sampler.pt")
+
+    def loads(self, path):
+        self.load_state_dict(torch.load(Path(path).absolute() / "sampler.pt"))
+
+
 def make_replay_buffer(
     batch_size,
     prb=False,
@@ -152,29 +252,51 @@ def make_replay_buffer(
     scratch_dir=None,
     device="cpu",
     prefetch=3,
+    pin_memory=False,
+    gpu_sampler=False,
+    sampler_device=None,
 ):
-    if prb:
+    if torch.device(device).type == "cpu":
+        storage_cls = functools.partial(
+            LazyMemmapStorage, scratch_dir=scratch_dir, device=device
+        )
+    else:
+        # Device-resident buffers are kept in plain tensors rather than memmaps
+        storage_cls = functools.partial(LazyTensorStorage, device=device)
+    if gpu_sampler and not prb:
+        raise ValueError("gpu_sampler=True requires a prioritized buffer (prb=True).")
+    if sampler_device is None:
+        sampler_device = device
+    if gpu_sampler and torch.device(sampler_device).type == "cpu":
+        # On CPU, scanning all the priorities is slower than the sum-tree
+        raise ValueError(
+            "gpu_sampler=True requires the sampler priorities to live on an "
+            f"accelerator, got sampler_device={sampler_device}."
+        )
+    if prb and gpu_sampler:
+        replay_buffer = TensorDictReplayBuffer(
+            pin_memory=pin_memory,
+            prefetch=prefetch,
+            storage=storage_cls(buffer_size),
+            sampler=MultinomialPrioritizedSampler(
+                buffer_size, alpha=0.7, beta=0.5, device=sampler_device
+            ),
+            batch_size=batch_size,
+        )
+    elif prb:
         replay_buffer = TensorDictPrioritizedReplayBuffer(
             alpha=0.7,
             beta=0.5,
-            pin_memory=False,
+            pin_memory=pin_memory,
             prefetch=prefetch,
-            storage=LazyMemmapStorage(
-                buffer_size,
-                scratch_dir=scratch_dir,
-                device=device,
-            ),
+            storage=storage_cls(buffer_size),
             batch_size=batch_size,
         )
     else:
         replay_buffer = TensorDictReplayBuffer(
-            pin_memory=False,
+            pin_memory=pin_memory,
             prefetch=prefetch,
-            storage=LazyMemmapStorage(
-                buffer_size,
-                scratch_dir=scratch_dir,
-                device=device,
-            ),
+            storage=storage_cls(buffer_size),
             batch_size=batch_size,
         )
     return replay_buffer
@@ -377,25 +499,32 @@ def make_discrete_cql_optimizer(cfg, loss_module):
 def make_continuous_cql_optimizer(cfg, loss_module):
     critic_params = loss_module.qvalue_network_params.flatten_keys().values()
     actor_params = loss_module.actor_network_params.flatten_keys().values()
+    # All the parameters live on the same device: on CUDA, each optimizer step is
+    # performed by a single fused kernel
+    fused = loss_module.log_alpha.device.type == "cuda"
     actor_optim = torch.optim.Adam(
         actor_params,
         lr=cfg.optim.actor_lr,
         weight_decay=cfg.optim.weight_decay,
+        fused=fused,
     )
     critic_optim = torch.optim.Adam(
         critic_params,
         lr=cfg.optim.critic_lr,
         weight_decay=cfg.optim.weight_decay,
+        fused=fused,
     )
     alpha_optim = torch.optim.Adam(
         [loss_module.log_alpha],
         lr=cfg.optim.actor_lr,
         weight_decay=cfg.optim.weight_decay,
+        fused=fused,
     )
     if loss_module.with_lagrange:
         alpha_prime_optim = torch.optim.Adam(
             [loss_module.log_alpha_prime],
             lr=cfg.optim.critic_lr,
+            fused=fused,
         )
     else:
         alpha_prime_optim = None